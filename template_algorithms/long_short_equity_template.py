@@ -42,6 +42,11 @@ NUM_SHORT_POSITIONS = 300
 MAX_SHORT_POSITION_SIZE = 2.0*1.0/(NUM_LONG_POSITIONS+NUM_SHORT_POSITIONS)
 MAX_LONG_POSITION_SIZE = 2.0*1.0/(NUM_LONG_POSITIONS+NUM_SHORT_POSITIONS)
 
+# The risk model factors that we want to neutralize in the optimization
+# step. We add its columns to our own pipeline and use its column names
+# to split them back out of the pipeline output.
+RISK_LOADING_PIPELINE = risk_loading_pipeline()
+
 def make_pipeline():
     """
     Create and return our pipeline.
@@ -83,18 +88,23 @@ def make_pipeline():
     longs = combined_factor.top(NUM_LONG_POSITIONS, mask=universe)
     shorts = combined_factor.bottom(NUM_SHORT_POSITIONS, mask=universe)
 
-    # The final output of our pipeline should only include
-    # the top/bottom 300 stocks by our criteria
-    long_short_screen = (longs | shorts)
-    
-    # Create pipeline
+    # rebalance only needs to know which stocks are in the top/bottom
+    # 300, so we output the longs and shorts as a single column.
+    columns = {
+        'long_short':longs | shorts,
+        'combined_factor':combined_factor
+    }
+    # Add the risk model loadings as extra columns, so that one pipeline
+    # is run each day instead of two separate pipelines.
+    columns.update(RISK_LOADING_PIPELINE.columns)
+
+    # Create pipeline. We keep the risk pipeline's screen rather than only
+    # outputting the top/bottom 300 stocks by our criteria, so that stocks
+    # we already hold still have risk loadings when the optimizer trades
+    # out of them.
     pipe = Pipeline(
-        columns = {
-            'longs':longs,
-            'shorts':shorts,
-            'combined_factor':combined_factor
-        },
-        screen = long_short_screen
+        columns = columns,
+        screen = RISK_LOADING_PIPELINE.screen
     )
     return pipe
 
@@ -110,10 +120,6 @@ def initialize(context):
 
     algo.attach_pipeline(make_pipeline(), 'long_short_equity_template')
 
-    # attach the pipeline for the risk model factors that we 
-    # want to neutralize in the optimization step
-    algo.attach_pipeline(risk_loading_pipeline(), 'risk_factors')
-
     # Schedule my rebalance function
     schedule_function(func=rebalance,
                       date_rule=date_rules.every_day(),
@@ -131,10 +137,12 @@ def before_trading_start(context, data):
     # Note: this is a dataframe where the index is the SIDs for all
     # securities to pass my screen and the columns are the factors
     # added to the pipeline object above
-    context.pipeline_data = algo.pipeline_output('long_short_equity_template')
+    pipeline_data = algo.pipeline_output('long_short_equity_template')
 
-    # This dataframe will contain all of our risk loadings
-    context.risk_loadings = algo.pipeline_output('risk_factors')
+    # Split the risk loadings back out from our factor columns
+    risk_factor_names = list(RISK_LOADING_PIPELINE.columns)
+    context.risk_loadings = pipeline_data[risk_factor_names]
+    context.pipeline_data = pipeline_data.drop(risk_factor_names, axis=1)
 
 def recording_statements(context, data):
     # Plot the number of positions over time.
@@ -154,7 +162,10 @@ def rebalance(context, data):
     # ranking to be proportional to expected returns. This routine
     # will optimize the expected return of our algorithm, going
     # long on the highest expected return and short on the lowest.
-    objective = opt.MaximizeAlpha(pipeline_data.combined_factor)
+    # We only give alpha to the top/bottom 300 stocks by our criteria
+    objective = opt.MaximizeAlpha(
+        pipeline_data.combined_factor[pipeline_data.long_short]
+    )
     
     ### Define the list of constraints
     constraints = []
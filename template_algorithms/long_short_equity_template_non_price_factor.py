@@ -26,7 +26,7 @@ from quantopian.pipeline.data.psychsignal import aggregated_twitter_withretweets
 import numpy as np
 import pandas as pd
 
-from quantopian.pipeline.filters import Q1500US
+from quantopian.pipeline.filters import CustomFilter, Q1500US
 import quantopian.optimize as opt
 
 # Constraint Parameters
@@ -57,8 +57,64 @@ class Sentiment(CustomFactor):
     inputs =[aggregated_sentiment.bull_minus_bear]
     window_length = 200
     def compute(self, today, asset_ids, out, test):
-        
-        out[:] = np.nanmean(np.diff(test, axis=0), axis = 0)
+        # Write the mean directly into the output buffer supplied by
+        # pipeline rather than allocating a result array and copying it.
+        np.nanmean(np.diff(test, axis=0), axis=0, out=out)
+
+
+def rank_zscore(values):
+    """
+    Return the z-scored ordinal rank of each entry in values. Missing
+    values are left out of the ranking and come back as NaN.
+    """
+    result = np.full(values.shape, np.nan)
+    valid = ~np.isnan(values)
+    # Invert the sort order to get each entry's rank without sorting twice
+    order = values[valid].argsort(kind='mergesort')
+    ranks = np.empty(order.size)
+    ranks[order] = np.arange(1, order.size + 1)
+    result[valid] = (ranks - ranks.mean()) / ranks.std()
+    return result
+
+
+class CombinedRank(CustomFactor):
+    """
+    Sum of the rank z-scores of each of our input factors. This computes
+    in a single term what would otherwise take a separate rank and zscore
+    term per input.
+    """
+    window_length = 1
+    def compute(self, today, asset_ids, out, *inputs):
+        out[:] = 0.0
+        for factor in inputs:
+            out += rank_zscore(factor[-1])
+
+
+def select_extremes(values, k, largest):
+    """
+    Return a boolean mask selecting the k largest (or smallest) non-missing
+    entries in values. Uses a partial sort, since the order of the selected
+    entries doesn't matter.
+    """
+    result = np.zeros(values.shape, dtype=bool)
+    valid = np.flatnonzero(~np.isnan(values))
+    if k >= valid.size:
+        result[valid] = True
+        return result
+    keys = -values[valid] if largest else values[valid]
+    result[valid[np.argpartition(keys, k)[:k]]] = True
+    return result
+
+
+class Extremes(CustomFilter):
+    """
+    Filter selecting the k assets with the largest (or smallest) value of
+    the input factor each day.
+    """
+    window_length = 1
+    params = ('k', 'largest')
+    def compute(self, today, asset_ids, out, values, k, largest):
+        out[:] = select_extremes(values[-1], k, largest)
 
 def make_pipeline():
     """
@@ -94,16 +150,27 @@ def make_pipeline():
     # By applying a mask to the rank computations, we remove any stocks that failed
     # to meet our initial criteria **before** computing ranks.  This means that the
     # stock with rank 10.0 is the 10th-lowest stock that was included in the Q1500US.
-    combined_rank = (
-        sentiment.rank(mask=universe).zscore() +
-        value.rank(mask=universe).zscore() +
-        quality.rank(mask=universe).zscore()
+    combined_rank = CombinedRank(
+        inputs=[sentiment, value, quality],
+        mask=universe,
     )
 
     # Build Filters representing the top and bottom 150 stocks by our combined ranking system.
     # We'll use these as our tradeable universe each day.
-    longs = combined_rank.top(NUM_LONG_POSITIONS)
-    shorts = combined_rank.bottom(NUM_SHORT_POSITIONS)
+    longs = Extremes(
+        inputs=[combined_rank],
+        k=NUM_LONG_POSITIONS,
+        largest=True,
+        mask=universe,
+    )
+    # Shorts are only picked from stocks that aren't already longs, so the two
+    # sides never overlap even when fewer than 600 stocks have a valid rank.
+    shorts = Extremes(
+        inputs=[combined_rank],
+        k=NUM_SHORT_POSITIONS,
+        largest=False,
+        mask=universe & ~longs,
+    )
 
     # The final output of our pipeline should only include
     # the top/bottom 300 stocks by our criteria
@@ -121,14 +188,10 @@ def make_pipeline():
                     ).beta + 0.33*1.0
     
 
-    # Create pipeline
+    # Create pipeline. Every stock that passes the screen is either a long
+    # or a short, so we only output the longs filter to tell them apart.
     pipe = Pipeline(columns = {
         'longs':longs,
-        'shorts':shorts,
-        'combined_rank':combined_rank,
-        'quality':quality,
-        'value':value,
-        'sentiment':sentiment,
         'sector':sector,
         'market_beta':beta
     },
@@ -147,6 +210,24 @@ def initialize(context):
 
     attach_pipeline(make_pipeline(), 'long_short_equity_template')
 
+    # These constraints don't depend on pipeline data, so we build
+    # them once here and reuse them at every rebalance.
+    context.static_constraints = [
+        # Constrain our maximum gross leverage
+        opt.MaxGrossLeverage(MAX_GROSS_LEVERAGE),
+        # Require our algorithm to remain dollar neutral
+        opt.DollarNeutral(),
+        # With this constraint we enforce that no position can make up
+        # greater than MAX_SHORT_POSITION_SIZE on the short side and
+        # no greater than MAX_LONG_POSITION_SIZE on the long side. This
+        # ensures that we do not overly concentrate our portfolio in
+        # one security or a small subset of securities.
+        opt.PositionConcentration.with_equal_bounds(
+            min=-MAX_SHORT_POSITION_SIZE,
+            max=MAX_LONG_POSITION_SIZE
+        ),
+    ]
+
     # Schedule my rebalance function
     schedule_function(func=rebalance,
                       date_rule=date_rules.month_start(),
@@ -159,14 +240,6 @@ def initialize(context):
                       half_days=True)
 
 
-def before_trading_start(context, data):
-    # Call pipeline_output to get the output
-    # Note: this is a dataframe where the index is the SIDs for all
-    # securities to pass my screen and the columns are the factors
-    # added to the pipeline object above
-    context.pipeline_data = pipeline_output('long_short_equity_template')
-
-
 def recording_statements(context, data):
     # Plot the number of positions over time.
     record(num_positions=len(context.portfolio.positions))
@@ -175,8 +248,15 @@ def recording_statements(context, data):
 # Called at the start of every month in order to rebalance
 # the longs and shorts lists
 def rebalance(context, data):
+    # Call pipeline_output to get the output
+    # Note: this is a dataframe where the index is the SIDs for all
+    # securities to pass my screen and the columns are the factors
+    # added to the pipeline object above. We only need it when we
+    # rebalance, so we fetch it here rather than every day in
+    # before_trading_start.
+    pipeline_data = pipeline_output('long_short_equity_template')
+
     ### Optimize API
-    pipeline_data = context.pipeline_data
     todays_universe = pipeline_data.index
     
     ### Extract from pipeline any specific risk factors you want 
@@ -191,27 +271,33 @@ def rebalance(context, data):
     # so we assume any missing values have full exposure to the market.
     
     
-    ### Here we define our objective for the Optimize API. We have
-    # selected MaximizeAlpha because we believe our combined factor
-    # ranking to be proportional to expected returns. This routine
-    # will optimize the expected return of our algorithm, going
-    # long on the highest expected return and short on the lowest.
-    objective = opt.MaximizeAlpha(pipeline_data.combined_rank)
+    ### Here we define our objective for the Optimize API. Our alpha
+    # only decides which stocks go long and which go short, so we can
+    # write down the equal-weighted portfolio across them directly and
+    # use TargetWeights. Each side gets half of our gross leverage, split
+    # evenly across the stocks actually selected for it. The optimizer
+    # then only has to find the closest portfolio that also meets our
+    # sector and beta constraints.
+    longs = pipeline_data.longs
+    shorts = ~longs
+    target_weights = pd.Series(0.0, index=todays_universe)
+    if longs.any():
+        target_weights[longs] = 0.5 * MAX_GROSS_LEVERAGE / longs.sum()
+    if shorts.any():
+        target_weights[shorts] = -0.5 * MAX_GROSS_LEVERAGE / shorts.sum()
+    objective = opt.TargetWeights(target_weights)
     
-    ### Define the list of constraints
-    constraints = []
-    # Constrain our maximum gross leverage
-    constraints.append(opt.MaxGrossLeverage(MAX_GROSS_LEVERAGE))
-    # Require our algorithm to remain dollar neutral
-    constraints.append(opt.DollarNeutral())
+    ### Define the list of constraints, starting from the ones
+    # that were built once in initialize
+    constraints = list(context.static_constraints)
     # Add a sector neutrality constraint using the sector
     # classifier that we included in pipeline
-    constraints.append(
-        opt.NetGroupExposure.with_equal_bounds(
-            labels=pipeline_data.sector,
-            min=-MAX_SECTOR_EXPOSURE,
-            max=MAX_SECTOR_EXPOSURE,
-        ))
+    sector_constraint = opt.NetGroupExposure.with_equal_bounds(
+        labels=pipeline_data.sector,
+        min=-MAX_SECTOR_EXPOSURE,
+        max=MAX_SECTOR_EXPOSURE,
+    )
+    constraints.append(sector_constraint)
     # Take the risk factors that you extracted above and
     # list your desired max/min exposures to them -
     # Here we selection +/- 0.01 to remain near 0.
@@ -221,23 +307,12 @@ def rebalance(context, data):
         max_exposures={'market_beta':MAX_BETA_EXPOSURE}
         )
     constraints.append(neutralize_risk_factors)
-    
-    # With this constraint we enforce that no position can make up
-    # greater than MAX_SHORT_POSITION_SIZE on the short side and
-    # no greater than MAX_LONG_POSITION_SIZE on the long side. This
-    # ensures that we do not overly concentrate our portfolio in
-    # one security or a small subset of securities.
-    constraints.append(
-        opt.PositionConcentration.with_equal_bounds(
-            min=-MAX_SHORT_POSITION_SIZE,
-            max=MAX_LONG_POSITION_SIZE
-        ))
 
     ### Put together all the pieces we defined above by passing
     # them into the order_optimal_portfolio function. This handles
     # all of our ordering logic, assigning appropriate weights
-    # to the securities in our universe to maximize our alpha with
-    # respect to the given constraints.
+    # to the securities in our universe that are closest to our
+    # targets with respect to the given constraints.
     order_optimal_portfolio(
         objective=objective,
         constraints=constraints